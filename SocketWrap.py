@@ -1,11 +1,22 @@
 from enum import Enum
 import pickle
 import json
+import zlib
+import sys
+import threading
+import weakref
+import queue
 import socket as _socket
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 from Log import *
 
 LONG_STR_LENGHT = 256
+## Size of the buffer used when receiving into a memmap
+MEMMAP_RECV_SIZE = 1024*1024
+## Messages of this size or larger send a 64bit size after this marker, instead of a 32bit size
+LARGE_MESSAGE_SIZE = 0xFFFFFFFF
 SHORT_STR = 1
 LONG_STR = 2
 INT = 3
@@ -14,6 +25,15 @@ NUMPY_ARRAY = 5
 FILE = 6
 PICKLE = 7
 LIST = 8
+NUMPY_SCHEMA = 9
+NUMPY_CACHED = 10
+NUMPY_KEYFRAME = 11
+NUMPY_DELTA = 12
+
+## Backpressure policies for the asynchronous send queue, see Socket.enableAsyncSend
+QUEUE_BLOCK = 0
+QUEUE_DROP = 1
+QUEUE_ERROR = 2
 
 class InvalidAddressOrPort(Exception):
 	def __init__(self, address, port):
@@ -22,6 +42,346 @@ class ConnectionLost(Exception):
 	def __init__(self, socket):
 		super().__init__("Connection to {}:{} lost".format(socket.address, socket.port))
 		self.socket = socket
+class SendQueueFull(Exception):
+	def __init__(self, socket):
+		super().__init__("Send queue to {}:{} is full".format(socket.address, socket.port))
+		self.socket = socket
+
+## Check if a message is sent as a numpy array
+#
+# Subclasses such as np.memmap are included, masked arrays are left to pickle so the mask is kept.
+def _isNumpyArray(msg):
+	return isinstance(msg, np.ndarray) and not isinstance(msg, np.ma.MaskedArray)
+
+## Approximate number of bytes a message will occupy on the wire
+#
+# Used for the byte limit of the asynchronous send queue, so it does not have to be exact.
+def _messageSize(msg):
+	if _isNumpyArray(msg): return msg.nbytes
+	if isinstance(msg, (str, bytes, bytearray)): return len(msg)
+	return sys.getsizeof(msg)
+
+## Background writer used by Socket when asynchronous sending is enabled.
+#
+# Messages are queued by Socket.send and serialised on a dedicated thread. Everything that is waiting when the thread wakes up is written as one batch,
+# small pieces of the batch are joined together so that many small messages end up in a few sendall calls.
+# A message counts against the queue limits until it has been handed to the kernel.
+# \see Socket.enableAsyncSend
+class _AsyncWriter():
+	def __init__(self, socket, maxMessages, maxBytes, policy, coalesceBytes):
+		self.socket = socket
+		self.maxMessages = maxMessages
+		self.maxBytes = maxBytes
+		self.policy = policy
+		self.coalesceBytes = coalesceBytes
+		self.queue = deque()
+		self.pendingMessages = 0
+		self.pendingBytes = 0
+		self.closed = False
+		self.error = None
+		self.condition = threading.Condition()
+		self.thread = threading.Thread(target = self._run)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	## Check if a message of the given size has to wait for room in the queue
+	#
+	# A single message is always accepted by an empty queue, even if it is larger than maxBytes.
+	def _full(self, size):
+		if self.pendingMessages == 0: return False
+		if self.maxMessages is not None and self.pendingMessages >= self.maxMessages: return True
+		if self.maxBytes is not None and self.pendingBytes + size > self.maxBytes: return True
+		return False
+	
+	## Queue a message
+	#
+	# \exception SendQueueFull The queue is full and the policy is QUEUE_ERROR
+	# @param channel The delta encoding channel, see Socket.send
+	# @return A future that completes when the message has been handed to the kernel. If the message was dropped the future is cancelled.
+	def put(self, msg, channel = None):
+		size = _messageSize(msg)
+		future = Future()
+		with self.condition:
+			while True:
+				if self.error is not None: raise self.error
+				if not self._full(size): break
+				if self.policy == QUEUE_DROP:
+					future.cancel()
+					return future
+				if self.policy == QUEUE_ERROR:
+					raise SendQueueFull(self.socket)
+				self.condition.wait()
+			self.queue.append((msg, channel, size, future))
+			self.pendingMessages += 1
+			self.pendingBytes += size
+			self.condition.notify_all()
+		return future
+	
+	## Wait until every queued message has been handed to the kernel
+	#
+	# \exception ConnectionLost If the writer failed, the error is raised here as well
+	def flush(self):
+		with self.condition:
+			while self.pendingMessages and self.error is None:
+				self.condition.wait()
+			if self.error is not None: raise self.error
+	
+	## Drain the queue and stop the writer thread
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+		self.thread.join()
+		if self.error is not None: raise self.error
+	
+	def _run(self):
+		while True:
+			with self.condition:
+				while not self.queue and not self.closed:
+					self.condition.wait()
+				if not self.queue: return
+				batch = list(self.queue)
+				self.queue.clear()
+			try:
+				self.socket._writeBatch(batch, self.coalesceBytes)
+			except Exception as e:
+				with self.condition:
+					self.error = e
+					for msg, channel, size, future in batch + list(self.queue):
+						if not future.done(): future.set_exception(e)
+					self.queue.clear()
+					self.condition.notify_all()
+				return
+			with self.condition:
+				self.pendingMessages -= len(batch)
+				self.pendingBytes -= sum(size for msg, channel, size, future in batch)
+				self.condition.notify_all()
+
+## Find the bytearray that holds the memory of a received object
+#
+# Follows numpy bases and memoryviews down to the underlying buffer.
+def _bufferOwner(obj):
+	while isinstance(obj, np.ndarray) and obj.base is not None:
+		obj = obj.base
+	if isinstance(obj, memoryview):
+		obj = obj.obj
+	return obj
+
+## A bytearray that can be weakly referenced, used for the buffers of BufferPool
+class _PooledBuffer(bytearray):
+	__slots__ = ("__weakref__",)
+
+## A size classed pool of receive buffers
+#
+# Buffers are rounded up to the next power of two (at least minSize) and kept in a free list per size class when they are released.
+# A steady stream of similar messages will then reuse the same few buffers instead of allocating new memory for every message.
+# When more than maxBytes are kept free, buffers from the least recently used size class are evicted.
+# The pool does not keep leased buffers alive, a buffer that is garbage collected without being released is simply forgotten.
+# \see Socket.enableBufferPool
+class BufferPool():
+	
+	## Constructor
+	#
+	# @param maxBytes The maximum number of bytes kept in released buffers
+	# @param maxPerClass The maximum number of released buffers kept for each size class
+	# @param minSize The smallest size class
+	def __init__(self, maxBytes = 256*1024*1024, maxPerClass = 8, minSize = 256):
+		self.maxBytes = maxBytes
+		self.maxPerClass = maxPerClass
+		self.minSize = minSize
+		self.free = OrderedDict()
+		self.freeBytes = 0
+		self.leased = {}
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lost = 0
+		self.lock = threading.RLock()
+	
+	def _sizeClass(self, size):
+		return max(self.minSize, 1 << (size - 1).bit_length())
+	
+	## Lease a buffer
+	#
+	# @param size The number of bytes needed
+	# @return A writable memoryview of exactly size bytes. The buffer is returned to the pool with release.
+	def lease(self, size):
+		sizeClass = self._sizeClass(size)
+		buffer = None
+		with self.lock:
+			buffers = self.free.get(sizeClass)
+			if buffers:
+				buffer = buffers.pop()
+				self.freeBytes -= sizeClass
+				self.free.move_to_end(sizeClass)
+				self.hits += 1
+			else:
+				self.misses += 1
+		if buffer is None: buffer = _PooledBuffer(sizeClass)
+		with self.lock: self.leased[id(buffer)] = weakref.finalize(buffer, self._lost, id(buffer))
+		return memoryview(buffer)[:size]
+	
+	## Forget a leased buffer that has been garbage collected without being released
+	def _lost(self, key):
+		with self.lock:
+			if self.leased.pop(key, None) is not None: self.lost += 1
+	
+	## Return a leased buffer to the pool
+	#
+	# \warning The object, and anything else sharing its memory, must not be used after it has been released.
+	# @param obj The leased memoryview, or an object using its memory (ex. a numpy array received with the pool)
+	# @return False if the object does not hold a buffer leased from this pool
+	def release(self, obj):
+		buffer = _bufferOwner(obj)
+		with self.lock:
+			finalizer = self.leased.get(id(buffer))
+			lease = finalizer.peek() if finalizer is not None else None
+			if lease is None or lease[0] is not buffer: return False
+			finalizer.detach()
+			del self.leased[id(buffer)]
+			sizeClass = len(buffer)
+			buffers = self.free.setdefault(sizeClass, [])
+			self.free.move_to_end(sizeClass)
+			if len(buffers) >= self.maxPerClass:
+				self.evictions += 1
+				return True
+			buffers.append(buffer)
+			self.freeBytes += sizeClass
+			while self.freeBytes > self.maxBytes:
+				sizeClass, buffers = next(iter(self.free.items()))
+				if not buffers:
+					del self.free[sizeClass]
+					continue
+				buffers.pop()
+				self.freeBytes -= sizeClass
+				self.evictions += 1
+		return True
+	
+	## Usage statistics of the pool
+	#
+	# @return A dict with hits, misses, hitRate, evictions, leased (buffers currently leased), lost (leases garbage collected without being released) and freeBytes (bytes kept in released buffers)
+	def stats(self):
+		with self.lock:
+			leases = self.hits + self.misses
+			return {"hits": self.hits, "misses": self.misses, "hitRate": self.hits / leases if leases else 0.0,
+				"evictions": self.evictions, "leased": len(self.leased), "lost": self.lost, "freeBytes": self.freeBytes}
+
+## Decode a long string, see Socket._recvRaw
+def _decodeString(data):
+	return str(data, 'utf-8')
+
+## Background receiver used by Socket when prefetching is enabled.
+#
+# A dedicated thread keeps receiving messages and hands the decoding to a thread pool (pickles optionally to a process pool).
+# The futures of the decoded messages are kept in a bounded queue, in the order they were received, so Socket.recv returns them in order.
+# \see Socket.enablePrefetch
+class _Prefetcher():
+	def __init__(self, socket, depth, workers, processes):
+		self.socket = socket
+		self.queue = queue.Queue(depth)
+		self.threadPool = ThreadPoolExecutor(workers)
+		self.processPool = ProcessPoolExecutor(processes) if processes else None
+		self.error = None
+		self.stopped = False
+		self.thread = threading.Thread(target = self._run)
+		self.thread.daemon = True
+	
+	## Start receiving
+	def start(self):
+		self.thread.start()
+	
+	## Get the next message
+	#
+	# \exception ConnectionLost If the connection was lost, after all messages received before that have been returned
+	def get(self):
+		if self.error is not None and self.queue.empty(): raise self.error
+		return self.queue.get().result()
+	
+	## Stop receiving and decoding
+	#
+	# Shuts down the socket to wake up the thread if it is waiting for data, and drops the prefetched messages in case it is waiting for room in the queue.
+	def close(self):
+		self.stopped = True
+		try: self.socket.socket.shutdown(_socket.SHUT_RDWR)
+		except OSError: pass
+		while self.thread.is_alive():
+			try:
+				while True: self.queue.get_nowait()
+			except queue.Empty: pass
+			self.thread.join(0.1)
+		self.threadPool.shutdown(wait = False)
+		if self.processPool is not None: self.processPool.shutdown(wait = False)
+	
+	## Put a message in the queue, giving up if the prefetcher is closed
+	def _put(self, future):
+		while not self.stopped:
+			try:
+				self.queue.put(future, timeout = 0.1)
+				return
+			except queue.Full: pass
+	
+	def _run(self):
+		while True:
+			try:
+				decode, payload = self.socket._recvRaw()
+				if decode is None:
+					future = Future()
+					future.set_result(payload)
+				elif decode is pickle.loads and self.processPool is not None:
+					data = bytes(payload)
+					self.socket._releaseData(payload)
+					future = self.processPool.submit(decode, data)
+				else:
+					future = self.threadPool.submit(self.socket._decode, decode, payload)
+			except Exception as e:
+				self.error = e
+				future = Future()
+				future.set_exception(e)
+				self._put(future)
+				return
+			self._put(future)
+			if self.stopped: return
+
+## Sender side state of a delta encoded channel
+#
+# \see Socket.enableDeltaEncoding
+class _DeltaChannel():
+	def __init__(self, keyframeInterval, blockSize, compress):
+		self.keyframeInterval = keyframeInterval
+		self.blockSize = blockSize
+		self.compress = compress
+		self.frame = None
+		self.sinceKeyframe = 0
+
+## Flat byte view of a contiguous numpy array
+def _byteView(array):
+	return array.reshape(-1).view(np.uint8)
+
+## Expand a mask of changed blocks to a mask of changed bytes
+def _blockToByteMask(blocks, blockSize, size):
+	return np.repeat(blocks, blockSize)[:size]
+
+## Encode the difference between two frames with the same shape and dtype
+#
+# The frames are split into blocks of blockSize bytes. The delta is a bitmask of the blocks that changed followed by the bytes of those blocks.
+# @return The delta as bytes
+def _encodeDelta(old, new, blockSize):
+	old = _byteView(old)
+	new = _byteView(new)
+	nBlocks = -(-len(new) // blockSize)
+	changed = np.zeros(nBlocks * blockSize, bool)
+	np.not_equal(old, new, out = changed[:len(new)])
+	blocks = changed.reshape(nBlocks, blockSize).any(1)
+	return np.packbits(blocks).tobytes() + new[_blockToByteMask(blocks, blockSize, len(new))].tobytes()
+
+## Apply a delta from _encodeDelta to a frame, in place
+def _applyDelta(frame, delta, blockSize):
+	frame = _byteView(frame)
+	nBlocks = -(-len(frame) // blockSize)
+	maskBytes = -(-nBlocks // 8)
+	delta = np.frombuffer(delta, np.uint8)
+	blocks = np.unpackbits(delta[:maskBytes])[:nBlocks].astype(bool)
+	frame[_blockToByteMask(blocks, blockSize, len(frame))] = delta[maskBytes:]
 		
 ## A wrapper for sockets that automatically resolves what is going to be sent and received.
 #
@@ -38,29 +398,37 @@ class Socket():
 		self.socket = socket
 		self.address = None
 		self.port = None
+		self._writer = None
+		self._capture = None
+		self._sendLock = threading.RLock()
+		self.bufferPool = None
+		self._sizeBuffer = bytearray(8)
+		self._schemaCache = None
+		self._schemaCacheSize = 0
+		self._schemas = {}
+		self._deltaSend = {}
+		self._deltaRecv = {}
+		self._prefetcher = None
 		try:
 			import bluetooth as bt
 			if type(self.socket) is bt.BluetoothSocket:
-				self._recv = self._bluetoothRecv
+				self._recvInto = self._bluetoothRecvInto
 		except:
 			# No bluetooth library
 			pass	
-	## Overrides _recv when using bluetooth
+	## Overrides _recvInto when using bluetooth
 	#
 	# Since bluetoothSocket does not have recv_into, this is used instead.
-	# \see _recv
-	def _bluetoothRecv(self, size):
-		ret = bytearray(size)
-		view = memoryview(ret)
+	# \see _recvInto
+	def _bluetoothRecvInto(self, view, size, chunkSize = LONG_STR_LENGHT):
 		toRead = size
 		while toRead:
-			bytes = self.socket.recv(min(toRead, LONG_STR_LENGHT))
+			bytes = self.socket.recv(min(toRead, chunkSize))
 			if bytes == b'': raise ConnectionLost(self)	
 			nbytes = len(bytes)
 			view[:nbytes] = bytes
 			view = view[nbytes:]
 			toRead -= nbytes
-		return ret
 	
 	## Bridge to base socket
 	def connect(self, address, port):
@@ -68,14 +436,117 @@ class Socket():
 		self.port = port
 		self.socket.connect((address, port))
 		
-	## Bridge to base socket
+	## Close the connection
+	#
+	# If asynchronous sending is enabled the queue is drained before the socket is closed.
 	def close(self):
-		self.socket.close()
+		try: self.disableAsyncSend()
+		finally:
+			if self._prefetcher is not None: self._prefetcher.close()
+			self.socket.close()
+	
+	## Send messages from a background thread
+	#
+	# After this send() queues the message and returns immediately with a concurrent.futures.Future, that completes when the message has been handed to the kernel.
+	# A dedicated thread serialises the queued messages, in order, and coalesces small messages into fewer system calls.
+	# \warning The message is serialised later, do not modify it (ex. a numpy array) until the future is done.
+	# @param maxMessages The maximum number of messages waiting to be sent. None for no limit.
+	# @param maxBytes The maximum (approximate) number of bytes waiting to be sent. None for no limit.
+	# @param policy What send() does when the queue is full. QUEUE_BLOCK waits for room, QUEUE_DROP returns a cancelled future and QUEUE_ERROR raises SendQueueFull.
+	# @param coalesceBytes Pieces smaller than this are joined together before being sent.
+	def enableAsyncSend(self, maxMessages = 1024, maxBytes = 64*1024*1024, policy = QUEUE_BLOCK, coalesceBytes = 64*1024):
+		self.disableAsyncSend()
+		self._writer = _AsyncWriter(self, maxMessages, maxBytes, policy, coalesceBytes)
+	
+	## Drain the send queue and go back to sending synchronously
+	#
+	# \exception ConnectionLost If any of the queued messages failed
+	def disableAsyncSend(self):
+		writer = self._writer
+		if writer is None: return
+		self._writer = None
+		writer.close()
+	
+	## Wait until all messages queued with send() have been handed to the kernel
+	#
+	# Does nothing when asynchronous sending is not enabled.
+	# \exception ConnectionLost If any of the queued messages failed
+	def flush(self):
+		if self._writer is not None: self._writer.flush()
+	
+	## Receive messages into pooled buffers
+	#
+	# Headers and payloads are received into buffers leased from a BufferPool instead of newly allocated memory.
+	# Strings, pickles and headers give their buffer back as soon as they have been decoded.
+	# Numpy arrays (and the data returned by sendRecv and recvSend) keep their buffer until they are given to release.
+	# Objects that are never released are simply garbage collected, the pool does not keep them alive.
+	# @param pool The pool to use, can be shared between sockets. If None a new BufferPool is created from **kwargs.
+	# @param **kwargs Arguments to BufferPool
+	def enableBufferPool(self, pool = None, **kwargs):
+		if pool is None: pool = BufferPool(**kwargs)
+		self.bufferPool = pool
+	
+	## Go back to allocating a new buffer for every message
+	def disableBufferPool(self):
+		self.bufferPool = None
+	
+	## Give the buffer of a received object back to the buffer pool
+	#
+	# \warning The object must not be used after it has been released, its memory will be reused by later messages.
+	# @param obj A numpy array received from this socket, or the data returned by sendRecv or recvSend
+	# @return False if the object does not hold a pooled buffer
+	def release(self, obj):
+		if self.bufferPool is None: return False
+		return self.bufferPool.release(obj)
+	
+	## Send the shape and dtype of numpy arrays only once
+	#
+	# The first array with a given shape and dtype defines an id for them, later arrays with the same shape and dtype only send the id.
+	# The receiving socket keeps the decoded shape and dtype for each id, so it does not have to unpickle the dtype again.
+	# When the cache is full the least recently used id is reused. Since only the sender decides which ids are in use, both peers stay in sync.
+	# @param size The maximum number of shapes and dtypes to remember, at least 1
+	def enableSchemaCache(self, size = 256):
+		if size < 1: raise ValueError("The schema cache size must be at least 1, not {}".format(size))
+		self._schemaCache = OrderedDict()
+		self._schemaCacheSize = size
+	
+	## Go back to sending the shape and dtype with every numpy array
+	def disableSchemaCache(self):
+		self._schemaCache = None
+	
+	## Receive and decode messages in the background
+	#
+	# After this a thread keeps receiving up to depth messages ahead of recv(), and decodes them (long strings and pickles) on a pool of worker threads.
+	# This overlaps the network transfer and the decoding with the processing of the previous messages. recv() still returns the messages in the order they were sent.
+	# Prefetching stays enabled until the socket is closed.
+	# \warning recv() can not take any arguments while prefetching, files are saved with their original name.
+	# \warning sendRecv and recvSend can not be used while prefetching.
+	# \warning Arrays received on a delta encoded channel are copied, since the next frame is received while the previous one is being used.
+	# @param depth The maximum number of messages received ahead
+	# @param workers The number of threads decoding messages
+	# @param processes If not 0, pickles are decoded in a pool of this many processes instead. This only pays off for large pickles that are slow to load, since the result has to be sent back from the process.
+	def enablePrefetch(self, depth = 8, workers = 2, processes = 0):
+		if self._prefetcher is None:
+			self._prefetcher = _Prefetcher(self, depth, workers, processes)
+			self._prefetcher.start()
+	
+	## Send numpy arrays on a channel as differences to the previous array
+	#
+	# Arrays sent with send(array, channel) are compared to the last array sent on the same channel, in blocks of blockSize bytes,
+	# and only the blocks that changed are sent. The receiver keeps the last frame of each channel and updates it in place.
+	# A full keyframe is sent every keyframeInterval frames, when the shape or dtype changes and whenever the delta would not be smaller than the array itself.
+	# @param channel Name of the channel, a str or an int, since it is sent in a json header
+	# @param keyframeInterval Number of frames between keyframes
+	# @param blockSize Size in bytes of the blocks that are compared
+	# @param compress If True the deltas are also compressed with zlib
+	def enableDeltaEncoding(self, channel, keyframeInterval = 30, blockSize = 256, compress = False):
+		if type(channel) not in (str, int): raise TypeError("Delta encoding channels must be str or int, not {}".format(type(channel).__name__))
+		self._deltaSend[channel] = _DeltaChannel(keyframeInterval, blockSize, compress)
+	
+	## Stop delta encoding a channel, arrays sent on it are sent in full again
+	def disableDeltaEncoding(self, channel):
+		self._deltaSend.pop(channel, None)
 	
-	## Bridge to base socket
-	def settimeout(self, *args):
-		self.socket.settimeout(*args)
-		
 	## Bridge to base socket
 	def settimeout(self, *args):
 		self.socket.settimeout(*args)
@@ -99,43 +570,131 @@ class Socket():
 	## Send a message. Will send size first followed by the message.
 	#
 	# Will first send a 32bit integer representing the size, followed immediatly by the message
+	# Messages of LARGE_MESSAGE_SIZE bytes or more send LARGE_MESSAGE_SIZE as the 32bit integer followed by the size as a 64bit integer.
 	# \warning This is intended for internal purposes and should not be used from the outside
 	# \exception ConnectionLost Connection to socket lost.
 	def _send(self, msg):
 		size = len(msg)
-		sent = self.socket.sendall(size.to_bytes(4, 'big'))
+		if size < LARGE_MESSAGE_SIZE: header = size.to_bytes(4, 'big')
+		else: header = LARGE_MESSAGE_SIZE.to_bytes(4, 'big') + size.to_bytes(8, 'big')
+		sent = self._sendall(header)
 		if sent == 0: raise ConnectionLost(self)
 	
-		sent = self.socket.sendall(msg)
+		sent = self._sendall(msg)
 		if sent == 0: raise ConnectionLost(self)
 		return sent
 	
+	## Send bytes to the base socket, or collect them when the background writer is serialising a batch
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	def _sendall(self, data):
+		if self._capture is None: return self.socket.sendall(data)
+		self._capture.append(data)
+	
+	## Send collected pieces, joining the small ones together
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	def _sendChunks(self, chunks, coalesceBytes):
+		small = []
+		for chunk in chunks:
+			if len(chunk) < coalesceBytes:
+				small.append(chunk)
+				continue
+			if small:
+				self.socket.sendall(b''.join(small))
+				small = []
+			self.socket.sendall(chunk)
+		if small: self.socket.sendall(b''.join(small))
+	
+	## Serialise and send a batch of queued messages
+	#
+	# Called from the background writer. The futures of the messages are completed once their bytes have been sent.
+	# A message that can not be serialised only fails its own future, errors from the socket are raised.
+	# \warning This is intended for internal purposes and should not be used from the outside
+	def _writeBatch(self, batch, coalesceBytes):
+		with self._sendLock:
+			chunks = []
+			chunkBytes = 0
+			written = []
+			def Flush():
+				self._sendChunks(chunks, coalesceBytes)
+				chunks.clear()
+				for future in written: future.set_result(None)
+				written.clear()
+			for msg, channel, size, future in batch:
+				if not future.set_running_or_notify_cancel(): continue
+				serialised = len(chunks)
+				self._capture = chunks
+				try: self._sendMessage(msg, channel)
+				except Exception as e:
+					del chunks[serialised:]
+					future.set_exception(e)
+					continue
+				finally: self._capture = None
+				written.append(future)
+				chunkBytes += size
+				if chunkBytes >= coalesceBytes:
+					Flush()
+					chunkBytes = 0
+			Flush()
+	
 	## Receive a message of the given size
 	#
 	# This method is used internally when receiving messages.
 	# \warning This is intended for internal purposes and should not be used from the outside
-	# Creates a bytearray and a view to that array, then fills the array using recv_into until the exact number of bytes has been received.
-	# \warning Should 
+	# Creates a bytearray and fills it with _recvInto.
 	def _recv(self, size):
 		bytes = bytearray(size)
-		view = memoryview(bytes)
+		self._recvInto(memoryview(bytes), size)
+		return bytes
+	
+	## Fill a buffer with exactly size bytes from the connection
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	# Fills the view using recv_into until the exact number of bytes has been received.
+	# @param chunkSize The maximum number of bytes for each call to recv_into
+	def _recvInto(self, view, size, chunkSize = LONG_STR_LENGHT):
 		toRead = size
 		while toRead:
-			nbytes = self.socket.recv_into(view, min(toRead, LONG_STR_LENGHT))
+			nbytes = self.socket.recv_into(view, min(toRead, chunkSize))
 			if nbytes == 0: raise ConnectionLost(self)	
 			view = view[nbytes:]
 			toRead -= nbytes
-		return bytes
+	
+	## Receive the size that precedes every message
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	# The size is received into the same small buffer every time.
+	# \see _send
+	def _recvSize(self):
+		view = memoryview(self._sizeBuffer)
+		self._recvInto(view, 4)
+		size = int.from_bytes(view[:4], 'big')
+		if size != LARGE_MESSAGE_SIZE: return size
+		self._recvInto(view, 8)
+		return int.from_bytes(view, 'big')
 	
 	## Receive a message. Will first get the size, followed by the message
 	#
 	# \warning This is intended for internal purposes and should not be used from the outside
 	# \warning Must be matched with a send
 	# This method will first wait for the size of the message. This is in the form of a 32bit integer.
-	# The message is then received.
+	# The message is then received, into a leased buffer if the buffer pool is enabled.
 	def _recvData(self):
-		size = int.from_bytes(self._recv(4), 'big')
-		return self._recv(size)
+		size = self._recvSize()
+		if self.bufferPool is None: return self._recv(size)
+		data = self.bufferPool.lease(size)
+		try: self._recvInto(data, size)
+		except:
+			self.bufferPool.release(data)
+			raise
+		return data
+	
+	## Give a buffer from _recvData back to the pool once it has been decoded
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	def _releaseData(self, data):
+		if self.bufferPool is not None: self.bufferPool.release(data)
 		
 	
 	## Send the type of the object to the connection
@@ -157,8 +716,10 @@ class Socket():
 	# \warning This is intended for internal purposes and should not be used from the outside
 	def _recvType(self):
 		data = self._recvData()
-		try: return json.loads(data.decode()) 		
-		except: return pickle.loads(data)
+		try:
+			try: return json.loads(str(data, 'utf-8'))
+			except: return pickle.loads(data)
+		finally: self._releaseData(data)
 			
 	## Send a string
 	#
@@ -178,24 +739,125 @@ class Socket():
 	## Send a numpy array
 	#
 	# First sends the type, shape and dtype
-	# Then sends the array itself
+	# Then sends the array itself, without copying it if it is contiguous (so large np.memmap arrays are read from disk as they are sent)
 	# \warning This is intended for internal purposes and should not be used from the outside	
 	def _sendNumpyArray(self, array):
-		self._sendType(NUMPY_ARRAY, (array.shape, array.dtype))
-		self._send(array.tobytes())
+		if self._schemaCache is None: self._sendType(NUMPY_ARRAY, (array.shape, array.dtype))
+		else: self._sendSchema(array)
+		self._send(memoryview(_byteView(np.ascontiguousarray(array))))
+	
+	## Send the type of a numpy array using the schema cache
+	#
+	# Sends NUMPY_CACHED with only the id if the shape and dtype have been sent before, otherwise NUMPY_SCHEMA with the id, shape and dtype.
+	# \warning This is intended for internal purposes and should not be used from the outside	
+	# \see enableSchemaCache
+	def _sendSchema(self, array):
+		key = (array.shape, array.dtype)
+		id = self._schemaCache.get(key)
+		if id is not None:
+			self._schemaCache.move_to_end(key)
+			self._sendType(NUMPY_CACHED, id)
+			return
+		if len(self._schemaCache) >= self._schemaCacheSize:
+			_, id = self._schemaCache.popitem(last = False)
+		else:
+			id = len(self._schemaCache)
+		self._schemaCache[key] = id
+		self._sendType(NUMPY_SCHEMA, (id, array.shape, array.dtype))
+	
+	## Send a numpy array on a delta encoded channel
+	#
+	# Sends NUMPY_DELTA with the changed blocks, or NUMPY_KEYFRAME with the full array.
+	# \warning This is intended for internal purposes and should not be used from the outside	
+	# \see enableDeltaEncoding
+	def _sendNumpyDelta(self, array, channel):
+		state = self._deltaSend[channel]
+		array = np.ascontiguousarray(array)
+		frame = state.frame
+		if frame is not None and frame.shape == array.shape and frame.dtype == array.dtype and state.sinceKeyframe < state.keyframeInterval:
+			delta = _encodeDelta(frame, array, state.blockSize)
+			compressed = False
+			if state.compress:
+				packed = zlib.compress(delta, 1)
+				if len(packed) < len(delta):
+					delta = packed
+					compressed = True
+			if len(delta) < array.nbytes:
+				self._sendType(NUMPY_DELTA, (channel, state.blockSize, compressed))
+				self._send(delta)
+				np.copyto(frame, array)
+				state.sinceKeyframe += 1
+				return
+		self._sendType(NUMPY_KEYFRAME, (channel, array.shape, array.dtype))
+		self._send(memoryview(_byteView(array)))
+		state.frame = array.copy()
+		state.sinceKeyframe = 1
+	
+	## Recieve a keyframe of a delta encoded channel
+	#
+	# The frame is received directly into a new array, that later deltas update in place.
+	# \warning This is intended for internal purposes and should not be used from the outside	
+	# @param channel_shape_dtype Tuple containing the channel, shape and dtype (in that order).
+	def _recvNumpyKeyframe(self, channel_shape_dtype):
+		channel, shape, dtype = channel_shape_dtype
+		size = self._recvSize()
+		frame = np.empty(shape, dtype)
+		self._recvInto(memoryview(_byteView(frame)), size)
+		self._deltaRecv[channel] = frame
+		if self._prefetcher is not None: return frame.copy()
+		return frame
+	
+	## Recieve a delta of a delta encoded channel and apply it to the last frame
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside	
+	# @param channel_blockSize_compressed Tuple containing the channel, block size and if the delta is compressed (in that order).
+	def _recvNumpyDelta(self, channel_blockSize_compressed):
+		channel, blockSize, compressed = channel_blockSize_compressed
+		delta = self._recvData()
+		try:
+			frame = self._deltaRecv[channel]
+			_applyDelta(frame, zlib.decompress(delta) if compressed else delta, blockSize)
+		finally: self._releaseData(delta)
+		if self._prefetcher is not None: return frame.copy()
+		return frame
 	
 	## Recieve a numpy array
 	#
 	# \warning This is intended for internal purposes and should not be used from the outside	
 	# This function constructs a numpy array and files the array with data from the connection
 	# @param shape_dtype Tuple containing the shape and dtype (in that order).
-	def _recvNumpyArray(self, shape_dtype ):
+	# @param memmapPath If not None the array is received into a np.memmap at this path instead, see _recvMemmap
+	def _recvNumpyArray(self, shape_dtype, memmapPath = None):
 		shape, dtype = shape_dtype
+		if memmapPath is not None: return self._recvMemmap(memmapPath, shape, dtype)
 		bytes = self._recvData()
 		array = np.frombuffer(bytes, dtype)
 		array.shape = shape
 		return array
 		
+	## Recieve a message directly into a np.memmap
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside	
+	# The message is streamed to the file through a buffer of MEMMAP_RECV_SIZE bytes, using large recv_into calls, so the resident memory stays bounded.
+	# The file is then mapped with np.memmap.
+	# @param path The file backing the memmap, it is created or overwritten.
+	# @param shape The shape of the memmap. If None it is a flat array of the message size.
+	# @param dtype The dtype of the memmap
+	# @return The np.memmap. Since an empty file can not be mapped, an empty message is returned as an empty np.ndarray and no file is created.
+	def _recvMemmap(self, path, shape, dtype):
+		size = self._recvSize()
+		if shape is None: shape = (size // np.dtype(dtype).itemsize,)
+		if size == 0: return np.empty(shape, dtype)
+		buffer = memoryview(bytearray(min(size, MEMMAP_RECV_SIZE)))
+		with open(path, 'wb') as file:
+			toRead = size
+			while toRead:
+				nbytes = min(toRead, len(buffer))
+				self._recvInto(buffer, nbytes, nbytes)
+				file.write(buffer[:nbytes])
+				toRead -= nbytes
+		return np.memmap(path, dtype, 'r+', shape = tuple(shape))
+	
 	## Send a file
 	#
 	# First sends the type, size and name.
@@ -238,7 +900,25 @@ class Socket():
 	#
 	# All types that can be pickled using pickle are supported, however, pickle can be slow, therefore a warning is printed each time something is sent using pickle.
 	# \warning When sending files, they are assumed to already be opened using f = open(...)
-	def send(self, msg):
+	# @param channel Numpy arrays sent on a channel with delta encoding enabled are delta encoded (see enableDeltaEncoding)
+	# @return None, or a future when asynchronous sending is enabled (see enableAsyncSend)
+	# \warning With asynchronous sending, files are still sent before send returns (after the queue has been flushed), since they are usually closed right after.
+	def send(self, msg, channel = None):
+		if self._writer is not None and type(msg).__name__ != 'BufferedReader':
+			return self._writer.put(msg, channel)
+		self.flush()
+		with self._sendLock:
+			self._sendMessage(msg, channel)
+		if self._writer is not None:
+			future = Future()
+			future.set_result(None)
+			return future
+	
+	## Resolve the type of the message and send it
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	# \see send
+	def _sendMessage(self, msg, channel = None):
 		if type(msg) == list or type(msg) == tuple:
 			self._sendType(LIST, msg)
 		elif isinstance(msg, str):
@@ -247,8 +927,9 @@ class Socket():
 			self._sendType(INT, msg)
 		elif isinstance(msg, Enum):
 			self._sendType(ENUM, msg)
-		elif type(msg) is np.ndarray:
-			self._sendNumpyArray(msg)
+		elif _isNumpyArray(msg):
+			if channel in self._deltaSend: self._sendNumpyDelta(msg, channel)
+			else: self._sendNumpyArray(msg)
 		elif type(msg).__name__ == 'BufferedReader':
 			self._sendFile(msg)	
 		else:
@@ -261,41 +942,81 @@ class Socket():
 	#
 	# This will automatically resolve the type that has been received and act accordingly.
 	# @param *args Any arguments to pass to the internal methods
+	# @param memmapPath If given numpy arrays are received directly into a np.memmap backed by this file, so arrays larger than the memory can be received.
+	# Long strings and pickles are then not decoded, the raw bytes are returned as a np.memmap of uint8 instead. Empty messages are returned as regular arrays.
 	# @param **kwargs Any keyword arguments to pass to the internal methods
-	def recv(self, *args, **kwargs):
+	# \warning Arrays received on a delta encoded channel are updated in place by the next frame on that channel, copy them if they need to be kept.
+	# \see enablePrefetch
+	def recv(self, *args, memmapPath = None, **kwargs):
+		if self._prefetcher is not None:
+			if args or kwargs or memmapPath is not None: raise ValueError("recv does not take any arguments while prefetching")
+			return self._prefetcher.get()
+		decode, payload = self._recvRaw(*args, memmapPath = memmapPath, **kwargs)
+		if decode is None: return payload
+		return self._decode(decode, payload)
+	
+	## Recieve a message without decoding it
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	# Long strings and pickles are returned as their raw bytes together with the function that decodes them, so the decoding can be done elsewhere.
+	# @return A tuple of the decode function and the payload. The decode function is None if the payload is the received message.
+	# \see recv
+	def _recvRaw(self, *args, memmapPath = None, **kwargs):
 		type, msg = self._recvType()
 		if type == SHORT_STR:
-			return msg
+			return None, msg
 		elif type == LONG_STR:
-			return  self._recvData().decode()	
+			if memmapPath is not None: return None, self._recvMemmap(memmapPath, None, np.uint8)
+			return _decodeString, self._recvData()
 		elif type == INT:
-			return msg
+			return None, msg
 		elif type == ENUM:
-			return msg
+			return None, msg
 		elif type == NUMPY_ARRAY:
-			return self._recvNumpyArray(msg)
+			return None, self._recvNumpyArray(msg, memmapPath)
+		elif type == NUMPY_SCHEMA:
+			id, shape, dtype = msg
+			self._schemas[id] = (shape, dtype)
+			return None, self._recvNumpyArray(self._schemas[id], memmapPath)
+		elif type == NUMPY_CACHED:
+			return None, self._recvNumpyArray(self._schemas[msg], memmapPath)
+		elif type == NUMPY_KEYFRAME:
+			return None, self._recvNumpyKeyframe(msg)
+		elif type == NUMPY_DELTA:
+			return None, self._recvNumpyDelta(msg)
 		elif type == LIST:
-			return msg
+			return None, msg
 		elif  type == FILE:
-			return self._recvFile(msg, *args, **kwargs)
+			return None, self._recvFile(msg, *args, **kwargs)
 		elif type == PICKLE:
-			bytes = self._recvData()
-			ret = pickle.loads(bytes)
-			return ret
+			if memmapPath is not None: return None, self._recvMemmap(memmapPath, None, np.uint8)
+			return pickle.loads, self._recvData()
+		return None, None
+	
+	## Decode a payload from _recvRaw and give its buffer back to the buffer pool
+	#
+	# \warning This is intended for internal purposes and should not be used from the outside
+	def _decode(self, decode, payload):
+		try: return decode(payload)
+		finally: self._releaseData(payload)
 			
 	## Send a message and immediatly wait for a response
 	# @see send
 	# @see recv
 	def sendRecv(self, msg):
-		self._send(msg)
+		if self._prefetcher is not None: raise ValueError("sendRecv can not be used while prefetching")
+		self.flush()
+		with self._sendLock: self._send(msg)
 		return self._recvData()
 	
 	## Recieve a msg and immediatly respond
 	# @see send
 	# @see recv
 	def recvSend(self, msg):
+		if self._prefetcher is not None: raise ValueError("recvSend can not be used while prefetching")
 		ret = self._recvData()
-		self._send(msg)
+		self.flush()
+		with self._sendLock: self._send(msg)
 		return ret
 
 if __name__ == "__main__":
@@ -421,6 +1142,168 @@ if __name__ == "__main__":
 			self.connection.send(TestEnum.A)
 			recv = self.client.recv()
 			assert recv == TestEnum.A
+		def SendAsync(self):
+			with Status_Info("Queued"):
+				self.connection.enableAsyncSend()
+				futures = [self.connection.send(i) for i in range(100)]
+				array = np.random.rand(32, 32)
+				futures.append(self.connection.send(array))
+				futures.append(self.connection.send("Test"))
+				for i in range(100):
+					assert self.client.recv() == i
+				assert np.array_equal(self.client.recv(), array)
+				assert self.client.recv() == "Test"
+				self.connection.flush()
+				for f in futures: assert f.done() and f.exception() is None
+			with Status_Info("Drop"):
+				self.connection.enableAsyncSend(maxMessages = 1, policy = QUEUE_DROP)
+				futures = [self.connection.send(i) for i in range(100)]
+				self.connection.disableAsyncSend()
+				sent = [i for i, f in enumerate(futures) if not f.cancelled()]
+				for i in sent:
+					assert self.client.recv() == i
+		def SendSchemaCache(self):
+			self.connection.enableSchemaCache(size = 2)
+			arrays = [np.random.rand(3, 2), np.arange(10), np.random.rand(3, 2), np.zeros((2, 2), np.uint8), np.arange(10)]
+			for array in arrays:
+				self.connection.send(array)
+				recv = self.client.recv()
+				assert np.array_equal(recv, array)
+				assert recv.dtype == array.dtype
+			self.connection.disableSchemaCache()
+			try:
+				self.connection.enableSchemaCache(size = 0)
+				assert False
+			except ValueError:
+				pass
+		def SendDelta(self):
+			for compress in [False, True]:
+				self.connection.enableDeltaEncoding("Grid", keyframeInterval = 5, compress = compress)
+				frame = np.random.rand(64, 64)
+				for i in range(12):
+					frame[i, :8] += 1
+					self.connection.send(frame, channel = "Grid")
+					recv = self.client.recv()
+					assert np.array_equal(recv, frame)
+				frame = np.random.rand(32, 32)
+				self.connection.send(frame, channel = "Grid")
+				assert np.array_equal(self.client.recv(), frame)
+				self.connection.disableDeltaEncoding("Grid")
+			try:
+				self.connection.enableDeltaEncoding(("Grid", 1))
+				assert False
+			except TypeError:
+				pass
+		def SendMemmap(self):
+			with Status_Info("Numpy array"):
+				array = np.random.rand(512, 256)
+				self.connection.send(array)
+				recv = self.client.recv(memmapPath = "Test.dat")
+				assert type(recv) is np.memmap
+				assert np.array_equal(recv, array)
+				del recv
+			with Status_Info("Long string"):
+				msg = "Test" * 1000
+				self.connection.send(msg)
+				recv = self.client.recv(memmapPath = "Test.dat")
+				assert recv.tobytes().decode() == msg
+				del recv
+			os.remove("Test.dat")
+			with Status_Info("Send memmap"):
+				array = np.memmap("Test.dat", np.float64, 'w+', shape = (1000,))
+				array[:] = np.arange(1000)
+				types = []
+				sendType = self.connection._sendType
+				self.connection._sendType = lambda type, data = (): (types.append(type), sendType(type, data))
+				self.connection.send(array)
+				del self.connection._sendType
+				assert types == [NUMPY_ARRAY]
+				assert np.array_equal(self.client.recv(), array)
+				del array
+				os.remove("Test.dat")
+			with Status_Info("Empty"):
+				self.connection.send(np.zeros(0))
+				assert self.client.recv(memmapPath = "Test.dat").size == 0
+				assert not os.path.exists("Test.dat")
+		def SendPrefetch(self):
+			import string
+			import random
+			listener = Socket()
+			listener.bind("127.0.0.1", 8081)
+			listener.listen(1)
+			connection = Socket()
+			connection.connect("127.0.0.1", 8081)
+			client, addr = listener.accept()
+			client.enablePrefetch(depth = 4)
+			msgs = [1, "Test", ''.join([random.choice(string.ascii_letters) for x in range(1000)]), Data(), [1, 2, 3], np.arange(10)]
+			for msg in msgs * 5:
+				connection.send(msg)
+			for msg in msgs * 5:
+				recv = client.recv()
+				if type(msg) is Data: assert recv.b == msg.b
+				elif type(msg) is np.ndarray: assert np.array_equal(recv, msg)
+				else: assert recv == msg
+			connection.close()
+			try:
+				client.recv()
+				assert False
+			except ConnectionLost:
+				pass
+			client.close()
+			with Status_Info("Close with a full queue"):
+				connection = Socket()
+				connection.connect("127.0.0.1", 8081)
+				client, addr = listener.accept()
+				client.enablePrefetch(depth = 1)
+				for i in range(5): connection.send(i)
+				assert client.recv() == 0
+				try:
+					client.sendRecv(b"Test")
+					assert False
+				except ValueError:
+					pass
+				client.close()
+				assert not client._prefetcher.thread.is_alive()
+				connection.close()
+			listener.close()
+		def SendAsyncErrors(self):
+			self.connection.enableAsyncSend()
+			with open("Test.txt", "w") as f:
+				f.write("Test")
+			with open("Test.txt", "rb") as f:
+				future = self.connection.send(f)
+			assert future.done()
+			assert self.client.recv(filename = "Test2.txt") == "Test2.txt"
+			os.remove("Test.txt")
+			os.remove("Test2.txt")
+			future = self.connection.send(lambda: None)
+			self.connection.send(1337)
+			self.connection.flush()
+			assert future.exception() is not None
+			assert self.client.recv() == 1337
+			self.connection.disableAsyncSend()
+		def SendBufferPool(self):
+			self.client.enableBufferPool()
+			array = np.random.rand(64, 64)
+			for i in range(10):
+				self.connection.send(array)
+				recv = self.client.recv()
+				assert np.array_equal(recv, array)
+				assert self.client.release(recv)
+			self.connection.send("Test")
+			assert self.client.recv() == "Test"
+			stats = self.client.bufferPool.stats()
+			assert stats["leased"] == 0
+			assert stats["hitRate"] > 0.5
+			self.connection.send(array)
+			recv = self.client.recv()
+			assert self.client.bufferPool.stats()["leased"] == 1
+			del recv
+			import gc
+			gc.collect()
+			assert self.client.bufferPool.stats()["leased"] == 0
+			assert self.client.bufferPool.stats()["lost"] == 1
+			self.client.disableBufferPool()
 	#with Status_Info("Normal socket"):
 	with Status_Info("Initiating test"): test = Test()
 	with Status_Info("SendInt"): test.SendInt()
@@ -431,6 +1314,13 @@ if __name__ == "__main__":
 	with Status_Info("SendClass"): test.SendClass()
 	with Status_Info("_sendFile"): test.SendFile()
 	with Status_Info("SendEnum"): test.SendEnum()
+	with Status_Info("SendAsync"): test.SendAsync()
+	with Status_Info("SendAsyncErrors"): test.SendAsyncErrors()
+	with Status_Info("SendBufferPool"): test.SendBufferPool()
+	with Status_Info("SendSchemaCache"): test.SendSchemaCache()
+	with Status_Info("SendDelta"): test.SendDelta()
+	with Status_Info("SendMemmap"): test.SendMemmap()
+	with Status_Info("SendPrefetch"): test.SendPrefetch()
 	'''with Status_Info("Bluetooth socket"):
 		with Status_Info("Initiating test"): test = Test(bluetooth = True)
 		with Status_Info("SendInt"): test.SendInt()